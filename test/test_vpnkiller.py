@@ -11,12 +11,19 @@
 """
 import unittest
 import sys
+import logging
+import os
+import signal
 import socket
+import tempfile
+import time
 import test.context  # pylint: disable=unused-import
 import mock
 from iamvpnlibrary import IAMVPNLibrary
 from openvpn_management import VPNmgmt
-from vpn_kill_users import VPNkiller, main
+from vpn_kill_users import VPNkiller, VerdictCache, IAMUnavailableError, CacheFileError
+from vpn_kill_users import BatchedStreamHandler
+from vpn_kill_users import main, main_loop, SignalStop
 if sys.version_info.major >= 3:
     from io import StringIO  # pragma: no cover
 else:
@@ -47,16 +54,54 @@ class TestVPNKiller(unittest.TestCase):
                               'VPN killer iam was not an IAM library')
         self.assertIsInstance(self.library.vpn, VPNmgmt,
                               'VPN killer vpn was not a VPNmgmt library')
+        self.assertEqual(self.library.iam_parallelism, 1,
+                         'VPN killer iam_parallelism did not default to 1')
+        self.assertEqual(self.library.connect_timeout, 5,
+                         'VPN killer connect_timeout did not default to 5')
+        self.assertEqual(self.library.verdicts.ttl, 0,
+                         'VPN killer cache ttl did not default to 0')
+        self.assertEqual(self.library.verdicts.deny_ttl, 90,
+                         'VPN killer cache deny_ttl did not default to 90')
+        library = VPNkiller(UNIX_SOCKET_FILENAME, iam_parallelism=4,
+                            connect_timeout=2, verdicts=VerdictCache(ttl=5))
+        self.assertEqual(library.iam_parallelism, 4,
+                         'VPN killer iam_parallelism was not settable')
+        self.assertEqual(library.connect_timeout, 2,
+                         'VPN killer connect_timeout was not settable')
+        self.assertEqual(library.verdicts.ttl, 5,
+                         'VPN killer cache ttl was not settable')
+        library.vpn_disconnect()
+
+    def test_01_lazy_iam(self):
+        """ Verify that the IAM object is only made when needed """
+        library = VPNkiller(UNIX_SOCKET_FILENAME)
+        self.assertIsNone(library._iam, 'VPN killer made an IAM object too early')
+        self.assertIsInstance(library.iam, IAMVPNLibrary,
+                              'VPN killer iam was not an IAM library')
+        self.assertIs(library.iam, library.iam, 'VPN killer iam was not reused')
+        library.vpn_disconnect()
+
+        library = VPNkiller(UNIX_SOCKET_FILENAME)
+        with mock.patch('iamvpnlibrary.IAMVPNLibrary', side_effect=ValueError('no ldap')):
+            with self.assertRaises(IAMUnavailableError) as raised:
+                _ = library.iam
+        self.assertIn('no ldap', str(raised.exception))
+        library.vpn_disconnect()
 
     def test_11_connect(self):
         """ Verify connections work """
-        with mock.patch.object(self.library.vpn, 'connect', return_value=None) as mock_connect:
+        with mock.patch.object(self.library.vpn, 'sock') as mock_sock, \
+                mock.patch.object(self.library.vpn, 'connect', side_effect=lambda: (
+                    mock_sock.settimeout.assert_called_once_with(5))) as mock_connect:
             retval = self.library.vpn_connect()
         self.assertTrue(retval)
         mock_connect.assert_called_once_with()
         with mock.patch.object(self.library.vpn, 'connect', side_effect=socket.error):
             retval = self.library.vpn_connect()
         self.assertFalse(retval)
+        with mock.patch.object(self.library.vpn, 'connect', side_effect=socket.timeout):
+            retval = self.library.vpn_connect()
+        self.assertFalse(retval)
 
     def test_12_disconnect(self):
         """ Verify disconnections work """
@@ -64,6 +109,20 @@ class TestVPNKiller(unittest.TestCase):
             self.library.vpn_disconnect()
         mock_connect.assert_called_once_with()
 
+    def test_13_reconnect(self):
+        """ Verify reconnections build a fresh VPN object """
+        old_vpn = self.library.vpn
+        with mock.patch.object(old_vpn, 'disconnect', side_effect=socket.error), \
+                mock.patch.object(VPNmgmt, 'connect', return_value=None) as mock_connect:
+            retval = self.library.vpn_reconnect()
+        self.assertTrue(retval)
+        mock_connect.assert_called_once_with()
+        self.assertIsInstance(self.library.vpn, VPNmgmt)
+        self.assertIsNot(self.library.vpn, old_vpn)
+        with mock.patch.object(VPNmgmt, 'connect', side_effect=socket.error):
+            retval = self.library.vpn_reconnect()
+        self.assertFalse(retval)
+
     def test_21_getusers(self):
         """ Verify that we correctly identify users """
         # This mocking is fairly simple; we rely on our libraries being sane.
@@ -77,35 +136,315 @@ class TestVPNKiller(unittest.TestCase):
                                   side_effect=[True, True, True, True, True]):
             retval = self.library.get_users_to_disconnect()
         self.assertEqual(retval, {})
+        self.library.clear_iam_cache()
         with mock.patch.object(self.library.vpn, 'getusers', return_value=users), \
                 mock.patch.object(self.library.iam, 'user_allowed_to_vpn',
                                   side_effect=[False, False, False, False, False]):
             retval = self.library.get_users_to_disconnect()
         self.assertEqual(retval, users)
+        self.library.clear_iam_cache()
         with mock.patch.object(self.library.vpn, 'getusers', return_value=users), \
                 mock.patch.object(self.library.iam, 'user_allowed_to_vpn',
                                   side_effect=[True, True, False, True, True]):
             retval = self.library.get_users_to_disconnect()
         self.assertEqual(len(retval), 1)  # jinkies
+        # Fanned out, the answers still line up with the right users.
+        self.library.clear_iam_cache()
+        self.library.iam_parallelism = 4
+        with mock.patch.object(self.library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(self.library.iam, 'user_allowed_to_vpn',
+                                  side_effect=lambda user: user != 'Velma'):
+            retval = self.library.get_users_to_disconnect()
+        self.assertEqual(retval, {'Velma': ['Velma', '192.168.10.30']})
+
+    def test_21_getusers_cached(self):
+        """ Verify that we remember IAM answers for a while """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'], }
+        # By default, only a "no" is remembered.
+        with mock.patch.object(self.library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(self.library.iam, 'user_allowed_to_vpn',
+                                  side_effect=lambda user: user == 'Fred') as mock_check:
+            self.library.get_users_to_disconnect()
+            self.library.get_users_to_disconnect()
+        mock_check.assert_has_calls([mock.call('Fred'), mock.call('Daphne'),
+                                     mock.call('Fred')])
+        self.assertEqual(mock_check.call_count, 3)
+        library = VPNkiller(UNIX_SOCKET_FILENAME, verdicts=VerdictCache(ttl=60, deny_ttl=30))
+        with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(library.iam, 'user_allowed_to_vpn',
+                                  side_effect=lambda user: user == 'Fred') as mock_check, \
+                mock.patch('vpn_kill_users.time.monotonic', return_value=600) as mock_time:
+            # First pass asks about both users...
+            self.assertEqual(library.get_users_to_disconnect(),
+                             {'Daphne': ['Daphne', '192.168.10.20']})
+            self.assertEqual(mock_check.call_count, 2)
+            # ... while within both TTLs we just remember...
+            mock_time.return_value = 629
+            self.assertEqual(library.get_users_to_disconnect(),
+                             {'Daphne': ['Daphne', '192.168.10.20']})
+            self.assertEqual(mock_check.call_count, 2)
+            # ... a "no" is rechecked sooner...
+            mock_time.return_value = 631
+            self.assertEqual(library.get_users_to_disconnect(),
+                             {'Daphne': ['Daphne', '192.168.10.20']})
+            mock_check.assert_called_with('Daphne')
+            self.assertEqual(mock_check.call_count, 3)
+            # ... than a "yes" is.
+            mock_time.return_value = 660
+            self.assertEqual(library.get_users_to_disconnect(),
+                             {'Daphne': ['Daphne', '192.168.10.20']})
+            mock_check.assert_called_with('Fred')
+            self.assertEqual(mock_check.call_count, 4)
+            library.clear_iam_cache()
+            self.assertEqual(library.get_users_to_disconnect(),
+                             {'Daphne': ['Daphne', '192.168.10.20']})
+            self.assertEqual(mock_check.call_count, 6)
+        library.vpn_disconnect()
+
+    def test_21_getusers_cache_size(self):
+        """ Verify that we don't remember more IAM answers than we're allowed """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'],
+                 'Velma': ['Velma', '192.168.10.30'], }
+        library = VPNkiller(UNIX_SOCKET_FILENAME, verdicts=VerdictCache(ttl=60, size=2))
+        with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(library.iam, 'user_allowed_to_vpn',
+                                  return_value=True) as mock_check:
+            self.assertEqual(library.get_users_to_disconnect(), {})
+            self.assertEqual(mock_check.call_count, 3)
+            # Fred was the oldest, so he's the one we had to forget.
+            self.assertEqual(library.get_users_to_disconnect(), {})
+            self.assertEqual(mock_check.call_count, 4)
+            mock_check.assert_called_with('Fred')
+        library.vpn_disconnect()
+
+    def test_21_getusers_cache_file(self):
+        """ Verify that IAM answers can be kept on disk between runs """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'], }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'cache.sqlite')
+            library = VPNkiller(UNIX_SOCKET_FILENAME,
+                                verdicts=VerdictCache(ttl=60, cache_file=cache_file))
+            with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                    mock.patch.object(library.iam, 'user_allowed_to_vpn',
+                                      side_effect=lambda user: user == 'Fred') as mock_check:
+                self.assertEqual(library.get_users_to_disconnect(),
+                                 {'Daphne': ['Daphne', '192.168.10.20']})
+            self.assertEqual(mock_check.call_count, 2)
+            self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+            library.vpn_disconnect()
+
+            # A second run picks up where the first left off...
+            library = VPNkiller(UNIX_SOCKET_FILENAME,
+                                verdicts=VerdictCache(ttl=60, cache_file=cache_file))
+            with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                    mock.patch.object(library.iam, 'user_allowed_to_vpn') as mock_check:
+                self.assertEqual(library.get_users_to_disconnect(),
+                                 {'Daphne': ['Daphne', '192.168.10.20']})
+            mock_check.assert_not_called()
+            library.clear_iam_cache()
+            library.vpn_disconnect()
+
+            # ... unless the cache was cleared, or the answers are too old.
+            library = VPNkiller(UNIX_SOCKET_FILENAME,
+                                verdicts=VerdictCache(ttl=60, cache_file=cache_file))
+            with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                    mock.patch.object(library.iam, 'user_allowed_to_vpn',
+                                      return_value=True) as mock_check:
+                self.assertEqual(library.get_users_to_disconnect(), {})
+            self.assertEqual(mock_check.call_count, 2)
+            library.vpn_disconnect()
+            with mock.patch('vpn_kill_users.time.time', return_value=time.time() + 3600):
+                library = VPNkiller(UNIX_SOCKET_FILENAME,
+                                    verdicts=VerdictCache(ttl=60, cache_file=cache_file))
+            self.assertEqual(library.verdicts._verdicts, {})
+            library.vpn_disconnect()
+
+    def test_21_getusers_cache_file_ttl_lowered(self):
+        """ Verify that verdicts from the file are held to this run's TTLs """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'], }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, 'cache.sqlite')
+            library = VPNkiller(UNIX_SOCKET_FILENAME, verdicts=VerdictCache(
+                ttl=3600, deny_ttl=3600, cache_file=cache_file))
+            with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                    mock.patch.object(library.iam, 'user_allowed_to_vpn',
+                                      side_effect=lambda user: user == 'Fred'):
+                library.get_users_to_disconnect()
+            library.vpn_disconnect()
+
+            # Someone turned "allowed" caching back off, and Fred got revoked.
+            library = VPNkiller(UNIX_SOCKET_FILENAME, verdicts=VerdictCache(
+                ttl=0, deny_ttl=90, cache_file=cache_file))
+            self.assertEqual(list(library.verdicts._verdicts), ['Daphne'])
+            self.assertLessEqual(library.verdicts.get('Daphne')[1], time.monotonic() + 90)
+            with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                    mock.patch.object(library.iam, 'user_allowed_to_vpn',
+                                      return_value=False) as mock_check:
+                self.assertEqual(library.get_users_to_disconnect(), users)
+            mock_check.assert_called_once_with('Fred')
+            library.vpn_disconnect()
+
+    def test_21_getusers_cache_file_broken(self):
+        """ Verify that failing to write the cache file doesn't stop us """
+        users = {'Daphne': ['Daphne', '192.168.10.20'], }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.assertRaises(CacheFileError):
+                VerdictCache(cache_file=os.path.join(tmpdir, 'nowhere', 'cache.sqlite'))
+
+            library = VPNkiller(UNIX_SOCKET_FILENAME, verdicts=VerdictCache(
+                cache_file=os.path.join(tmpdir, 'cache.sqlite')))
+            library.verdicts._db.execute('DROP TABLE iam_cache')
+            with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                    mock.patch.object(library.iam, 'user_allowed_to_vpn', return_value=False), \
+                    self.assertLogs('vpn_kill_users', level='WARNING') as logs:
+                self.assertEqual(library.get_users_to_disconnect(), users)
+            self.assertIn('Unable to save IAM verdicts to cache', logs.output[0])
+            library.vpn_disconnect()
+
+    def test_21_iter_users(self):
+        """ Verify that we hand out users to kick one at a time """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'],
+                 'Velma': ['Velma', '192.168.10.30'], }
+        with mock.patch.object(self.library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(self.library.iam, 'user_allowed_to_vpn',
+                                  side_effect=lambda user: user != 'Daphne'):
+            retval = self.library.iter_users_to_disconnect()
+            self.assertNotIsInstance(retval, dict)
+            self.assertEqual(list(retval), [('Daphne', ['Daphne', '192.168.10.20'])])
+
+    def test_21_getusers_nobody(self):
+        """ Verify that we don't bother IAM when nobody is connected """
+        library = VPNkiller(UNIX_SOCKET_FILENAME)
+        with mock.patch.object(library.vpn, 'getusers', return_value={}):
+            retval = library.get_users_to_disconnect()
+        self.assertEqual(retval, {})
+        self.assertIsNone(library._iam, 'VPN killer made an IAM object for nobody')
+        library.vpn_disconnect()
+
+    def test_21_getusers_batch(self):
+        """ Verify that we prefer a batch IAM check when there is one """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'],
+                 'Velma': ['Velma', '192.168.10.30'], }
+        library = VPNkiller(UNIX_SOCKET_FILENAME, verdicts=VerdictCache(ttl=60))
+        with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(library.iam, 'users_allowed_to_vpn', create=True,
+                                  return_value=['Fred', 'Velma']) as mock_batch, \
+                mock.patch.object(library.iam, 'user_allowed_to_vpn') as mock_single:
+            retval = library.get_users_to_disconnect()
+        self.assertEqual(retval, {'Daphne': ['Daphne', '192.168.10.20']})
+        mock_batch.assert_called_once_with(['Fred', 'Daphne', 'Velma'])
+        mock_single.assert_not_called()
+
+        # Only people we haven't heard about lately get sent to IAM.
+        users['Shaggy'] = ['Shaggy', '192.168.10.40']
+        with mock.patch.object(library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(library.iam, 'users_allowed_to_vpn', create=True,
+                                  return_value=[]) as mock_batch:
+            retval = library.get_users_to_disconnect()
+        self.assertEqual(retval, {'Daphne': ['Daphne', '192.168.10.20'],
+                                  'Shaggy': ['Shaggy', '192.168.10.40']})
+        mock_batch.assert_called_once_with(['Shaggy'])
+        library.vpn_disconnect()
+
+    def test_21_getusers_batch_unimplemented(self):
+        """ Verify that we fall back to per-user checks if batch checks aren't there """
+        users = {'Fred': ['Fred', '192.168.10.10'],
+                 'Daphne': ['Daphne', '192.168.10.20'], }
+        with mock.patch.object(self.library.vpn, 'getusers', return_value=users), \
+                mock.patch.object(self.library.iam, 'users_allowed_to_vpn', create=True,
+                                  side_effect=NotImplementedError) as mock_batch, \
+                mock.patch.object(self.library.iam, 'user_allowed_to_vpn',
+                                  side_effect=lambda user: user == 'Fred') as mock_single:
+            retval = self.library.get_users_to_disconnect()
+        self.assertEqual(retval, {'Daphne': ['Daphne', '192.168.10.20']})
+        mock_batch.assert_called_once_with(['Fred', 'Daphne'])
+        self.assertEqual(mock_single.call_count, 2)
 
     def test_22_disconnect_real(self):
         """ Verify that we disconnect users """
         with mock.patch.object(self.library.vpn, 'kill',
                                return_value=[True, 'bye Scrappy']) as mock_kill, \
-                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                self.assertLogs('vpn_kill_users', level='INFO') as logs:
             killtest = self.library.disconnect_user(['Scrappy', '192.168.10.60'], commit=True)
-        self.assertIn('disconnecting from VPN: Scrappy / 192.168.10.60', fake_out.getvalue())
+        self.assertIn('disconnecting from VPN: Scrappy / 192.168.10.60', logs.output[0])
+        self.assertEqual(logs.records[0].user, 'Scrappy')
+        self.assertEqual(logs.records[0].src_ip, '192.168.10.60')
         mock_kill.assert_called_once_with('Scrappy', commit=True)
         self.assertTrue(killtest)
 
         with mock.patch.object(self.library.vpn, 'kill',
                                return_value=[True, 'bye Scrappy']) as mock_kill, \
-                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                self.assertLogs('vpn_kill_users', level='INFO') as logs:
             killtest = self.library.disconnect_user(['Scrappy', '192.168.10.60'], commit=False)
-        self.assertIn('disconnecting from VPN: Scrappy / 192.168.10.60', fake_out.getvalue())
+        self.assertIn('disconnecting from VPN: Scrappy / 192.168.10.60', logs.output[0])
         mock_kill.assert_called_once_with('Scrappy', commit=False)
         self.assertTrue(killtest)
 
+        with mock.patch.object(self.library.vpn, 'kill',
+                               return_value=[True, 'bye Scrappy']) as mock_kill, \
+                self.assertLogs('vpn_kill_users', level='INFO') as logs:
+            self.library.disconnect_user(['Scrappy', '192.168.10.60:1194'], commit=False)
+            self.library.disconnect_user(['Scrappy', '2001:db8::60:1194'], commit=False)
+        self.assertTrue(logs.output[0].endswith('disconnecting from VPN: Scrappy / 192.168.10.60'))
+        self.assertTrue(logs.output[1].endswith('disconnecting from VPN: Scrappy / 2001:db8::60'))
+
+    def test_23_disconnect_many(self):
+        """ Verify that we disconnect groups of users """
+        user_refs = [['Scrappy', '192.168.10.60'], ['Dum', '192.168.10.70']]
+        # No batch kill in the VPN library: one kill per user.
+        with mock.patch.object(self.library.vpn, 'kill',
+                               return_value=[True, 'bye']) as mock_kill, \
+                self.assertLogs('vpn_kill_users', level='INFO') as logs:
+            killtest = self.library.disconnect_users(user_refs, commit=True)
+        self.assertIn('disconnecting from VPN: Scrappy / 192.168.10.60', logs.output[0])
+        self.assertIn('disconnecting from VPN: Dum / 192.168.10.70', logs.output[1])
+        mock_kill.assert_has_calls([mock.call('Scrappy', commit=True),
+                                    mock.call('Dum', commit=True)])
+        self.assertEqual(killtest, [True, True])
+
+        # Batch kill available: one call for everyone.
+        with mock.patch.object(self.library.vpn, 'kill_many', create=True,
+                               return_value=[[True, 'bye'], [False, 'nope']]) as mock_many, \
+                mock.patch.object(self.library.vpn, 'kill') as mock_kill, \
+                self.assertLogs('vpn_kill_users', level='INFO') as logs:
+            killtest = self.library.disconnect_users(user_refs, commit=False)
+        self.assertIn('disconnecting from VPN: Scrappy / 192.168.10.60', logs.output[0])
+        self.assertIn('disconnecting from VPN: Dum / 192.168.10.70', logs.output[1])
+        mock_many.assert_called_once_with(['Scrappy', 'Dum'], commit=False)
+        mock_kill.assert_not_called()
+        self.assertEqual(killtest, [True, False])
+
+    def test_24_batched_log(self):
+        """ Verify that log lines are held, and written out together """
+        fake_out = mock.Mock(wraps=StringIO())
+        handler = BatchedStreamHandler(fake_out, capacity=3)
+        logger = logging.getLogger('test_24_batched_log')
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.warning('one')
+        logger.warning('two')
+        fake_out.write.assert_not_called()
+        handler.flush()
+        fake_out.write.assert_called_once_with('one\ntwo\n')
+        self.assertEqual(fake_out.getvalue(), 'one\ntwo\n')
+        handler.flush()
+        fake_out.write.assert_called_once_with('one\ntwo\n')
+        # The buffer filling up makes it write, too.
+        for word in ['three', 'four', 'five']:
+            logger.warning(word)
+        self.assertEqual(fake_out.getvalue(), 'one\ntwo\nthree\nfour\nfive\n')
+        logger.removeHandler(handler)
+
+
+class TestMain(unittest.TestCase):
+    """ Class of tests for the command-line and daemon entry points """
+
     def test_90_main_bad_args(self):
         ''' Test the main function entry with junk arguments '''
         with self.assertRaises(SystemExit):
@@ -123,14 +462,52 @@ class TestVPNKiller(unittest.TestCase):
                 main(['--noop'])
         self.assertIn('usage: ', fake_out.getvalue())
 
+        with self.assertRaises(SystemExit):
+            with mock.patch('sys.stderr', new=StringIO()) as fake_out:
+                main(['--iam-parallelism', '0', '/some/path'])
+        self.assertIn('0 is not a positive integer', fake_out.getvalue())
+
+        with self.assertRaises(SystemExit):
+            with mock.patch('sys.stderr', new=StringIO()) as fake_out:
+                main(['--iam-parallelism', 'lots', '/some/path'])
+        self.assertIn('lots is not a positive integer', fake_out.getvalue())
+
+        with self.assertRaises(SystemExit):
+            with mock.patch('sys.stderr', new=StringIO()) as fake_out:
+                main(['--iam-cache-ttl', '-1', '/some/path'])
+        self.assertIn('-1 is not a non-negative integer', fake_out.getvalue())
+
+        with self.assertRaises(SystemExit):
+            with mock.patch('sys.stderr', new=StringIO()) as fake_out:
+                main(['--iam-deny-cache-ttl', '-1', '/some/path'])
+        self.assertIn('-1 is not a non-negative integer', fake_out.getvalue())
+
+        with self.assertRaises(SystemExit):
+            with mock.patch('sys.stderr', new=StringIO()) as fake_out:
+                main(['--connect-timeout', '0', '/some/path'])
+        self.assertIn('0 is not a positive integer', fake_out.getvalue())
+
     def test_91_main_bad_attempts(self):
         ''' Test the main function entry with unworkable operations '''
         # This one is "try to connect to something that's not in existence"
+        for objerr in [socket.error, ImportError]:
+            with mock.patch.object(VPNkiller, '__init__', side_effect=objerr):
+                with self.assertRaises(SystemExit), \
+                        mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                    main(['1234'])
+                self.assertIn('Unable to create VPNkiller object', fake_out.getvalue())
+
+        # ... or a cache file we can't make
+        with self.assertRaises(SystemExit), \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            main(['--iam-cache-file', '/nonexistent/cache.sqlite', '/some/path'])
+        self.assertIn('Unable to create VPNkiller object: /nonexistent/cache.sqlite',
+                      fake_out.getvalue())
+
+        # ... but a bug is a bug, and we don't paper over it.
         with mock.patch.object(VPNkiller, '__init__', side_effect=ValueError):
-            with self.assertRaises(SystemExit), \
-                    mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            with self.assertRaises(ValueError):
                 main(['1234'])
-            self.assertIn('Unable to create VPNkiller object', fake_out.getvalue())
 
         # This one is "try to connect to something that's not a socket"
         with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller:
@@ -142,44 +519,162 @@ class TestVPNKiller(unittest.TestCase):
             instance.vpn_connect.assert_called_once()
             self.assertIn('Unable to connect to /some/path', fake_out.getvalue())
 
-    @staticmethod
-    def test_95_main_good():
+        # This one is "the VPN is fine, but IAM can't be reached"
+        with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller:
+            instance = mock_vpnkiller.return_value
+            instance.vpn_connect.return_value = True
+            instance.iter_users_to_disconnect.side_effect = IAMUnavailableError('no ldap')
+            with self.assertRaises(SystemExit), \
+                    mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                main(['/some/path'])
+            self.assertIn('Unable to create IAM object: no ldap', fake_out.getvalue())
+            instance.vpn_disconnect.assert_called_once_with()
+
+        # This one is "the VPN socket stops answering partway through"
+        with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller:
+            instance = mock_vpnkiller.return_value
+            instance.vpn_connect.return_value = True
+            instance.iter_users_to_disconnect.side_effect = socket.timeout('timed out')
+            with self.assertRaises(SystemExit), \
+                    mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                main(['/some/path'])
+            self.assertIn('Lost connection to /some/path: timed out', fake_out.getvalue())
+
+    def test_95_main_good(self):
         ''' Test the main function entry with good arguments '''
+        def kick(user_refs, commit):  # pylint: disable=unused-argument
+            """ Stand-in for disconnect_users that records who got kicked """
+            kicked.extend(user_refs)
+            return [True for _ in kicked]
+
         # This is "we have nobody to kick"
+        kicked = []
         with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller:
             instance = mock_vpnkiller.return_value
             instance.vpn_connect.return_value = True
-            instance.get_users_to_disconnect.return_value = {}
-            instance.disconnect_user.return_value = (True, 'some message')
+            instance.iter_users_to_disconnect.return_value = iter([])
+            instance.disconnect_users.side_effect = kick
             instance.vpn_disconnect.return_value = None
             main(['/some/path'])
+            mock_vpnkiller.assert_called_once_with('/some/path', iam_parallelism=1,
+                                                   connect_timeout=5, verdicts=mock.ANY)
+            verdicts = mock_vpnkiller.call_args[1]['verdicts']
+            self.assertEqual((verdicts.ttl, verdicts.deny_ttl, verdicts.size), (0, 90, 4096))
             instance.vpn_connect.assert_called_once()
-            instance.get_users_to_disconnect.assert_called_once()
-            instance.disconnect_user.assert_not_called()
+            instance.iter_users_to_disconnect.assert_called_once()
+            instance.disconnect_users.assert_called_once_with(mock.ANY, commit=True)
+            self.assertEqual(kicked, [])
+            instance.flush_log.assert_called_once_with()
             instance.vpn_disconnect.assert_called_once()
 
         # This is "we have one person to kick but we're in noop" mode
+        kicked = []
         with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller:
             instance = mock_vpnkiller.return_value
             instance.vpn_connect.return_value = True
-            instance.get_users_to_disconnect.return_value = {'a': ['a', '10.20.30.40']}
-            instance.disconnect_user.return_value = (True, 'some message')
+            instance.iter_users_to_disconnect.return_value = iter([('a', ['a', '10.20.30.40'])])
+            instance.disconnect_users.side_effect = kick
             instance.vpn_disconnect.return_value = None
-            main(['--noop', '/some/path'])
+            main(['--noop', '--iam-parallelism', '5', '--connect-timeout', '2',
+                  '--iam-deny-cache-ttl', '0', '/some/path'])
+            mock_vpnkiller.assert_called_once_with('/some/path', iam_parallelism=5,
+                                                   connect_timeout=2, verdicts=mock.ANY)
+            self.assertEqual(mock_vpnkiller.call_args[1]['verdicts'].deny_ttl, 0)
             instance.vpn_connect.assert_called_once()
-            instance.get_users_to_disconnect.assert_called_once()
-            instance.disconnect_user.assert_called_once_with(['a', '10.20.30.40'], commit=False)
+            instance.iter_users_to_disconnect.assert_called_once()
+            instance.disconnect_users.assert_called_once_with(mock.ANY, commit=False)
+            self.assertEqual(kicked, [['a', '10.20.30.40']])
+            instance.flush_log.assert_called_once_with()
             instance.vpn_disconnect.assert_called_once()
 
         # This is "we have one person to kick and we'll do it" mode
+        kicked = []
         with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller:
             instance = mock_vpnkiller.return_value
             instance.vpn_connect.return_value = True
-            instance.get_users_to_disconnect.return_value = {'b': ['b', '20.40.60.80']}
-            instance.disconnect_user.return_value = (True, 'some message')
+            instance.iter_users_to_disconnect.return_value = iter([('b', ['b', '20.40.60.80'])])
+            instance.disconnect_users.side_effect = kick
             instance.vpn_disconnect.return_value = None
             main(['/some/path'])
             instance.vpn_connect.assert_called_once()
-            instance.get_users_to_disconnect.assert_called_once()
-            instance.disconnect_user.assert_called_once_with(['b', '20.40.60.80'], commit=True)
+            instance.iter_users_to_disconnect.assert_called_once()
+            instance.disconnect_users.assert_called_once_with(mock.ANY, commit=True)
+            self.assertEqual(kicked, [['b', '20.40.60.80']])
+            instance.flush_log.assert_called_once_with()
             instance.vpn_disconnect.assert_called_once()
+
+    def test_96_main_loop(self):
+        ''' Test the long-running loop '''
+        stop = mock.Mock()
+        stop.is_set.side_effect = [False, False, False, False, True]
+        killer = mock.Mock()
+        killer.vpn_socket = '/some/path'
+        # Fine, then the socket breaks partway through kicking people off,
+        # then a connect fails, then IAM is unreachable.
+        killer.vpn_reconnect.side_effect = [True, True, False, True]
+        killer.iter_users_to_disconnect.side_effect = [
+            iter([('a', ['a', '10.20.30.40'])]), iter([('b', ['b', '20.40.60.80'])]),
+            IAMUnavailableError('no ldap')]
+        kicked = []
+
+        def kick(user_refs, commit):  # pylint: disable=unused-argument
+            """ Stand-in for disconnect_users whose second batch breaks the socket """
+            kicked.extend(user_refs)
+            if len(kicked) > 1:
+                raise socket.timeout('timed out')
+            return [True]
+        killer.disconnect_users.side_effect = kick
+        killer.vpn_disconnect.side_effect = [None, socket.error, None]
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            main_loop(killer, 30, commit=True, stop=stop)
+        self.assertEqual(killer.vpn_reconnect.call_count, 4)
+        self.assertEqual(killer.iter_users_to_disconnect.call_count, 3)
+        self.assertEqual(killer.disconnect_users.call_count, 2)
+        self.assertEqual(kicked, [['a', '10.20.30.40'], ['b', '20.40.60.80']])
+        # Every sweep that got going wrote out its log, failed or not.
+        self.assertEqual(killer.flush_log.call_count, 3)
+        self.assertEqual(killer.vpn_disconnect.call_count, 3)
+        self.assertEqual(stop.wait.call_args_list, [mock.call(30)] * 4)
+        self.assertIn('Lost connection to /some/path: timed out', fake_out.getvalue())
+        self.assertIn('Unable to connect to /some/path', fake_out.getvalue())
+        self.assertIn('Unable to create IAM object: no ldap', fake_out.getvalue())
+
+    def test_97_main_daemon(self):
+        ''' Test the main function entry in daemon mode '''
+        # main blocks SIGTERM for the rest of the process; undo that after.
+        self.addCleanup(signal.pthread_sigmask, signal.SIG_UNBLOCK, {signal.SIGTERM})
+        with mock.patch('vpn_kill_users.VPNkiller') as mock_vpnkiller, \
+                mock.patch('vpn_kill_users.main_loop') as mock_loop:
+            instance = mock_vpnkiller.return_value
+            main(['--daemon', '--interval', '10', '--noop', '/some/path'])
+            instance.vpn_connect.assert_not_called()
+            mock_loop.assert_called_once_with(instance, 10, commit=False, stop=mock.ANY)
+            stop = mock_loop.call_args[1]['stop']
+            self.assertIsInstance(stop, SignalStop)
+            self.assertEqual(stop.signum, signal.SIGTERM)
+            self.assertFalse(stop.wait(0))
+            # A SIGTERM asks the loop to wind down.
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.assertTrue(stop.wait(10))
+            self.assertTrue(stop.is_set())
+
+    def test_98_main_loop_sigterm(self):
+        ''' Test that a real SIGTERM mid-sweep ends the loop after that sweep '''
+        self.addCleanup(signal.pthread_sigmask, signal.SIG_UNBLOCK, {signal.SIGTERM})
+        stop = SignalStop(signal.SIGTERM)
+        killer = mock.Mock()
+        # If the SIGTERM were missed, a second sweep would fail to connect.
+        killer.vpn_reconnect.side_effect = [True, False]
+
+        def terminate():
+            """ Stand-in for iter_users_to_disconnect that gets us killed """
+            os.kill(os.getpid(), signal.SIGTERM)
+            return iter([])
+        killer.iter_users_to_disconnect.side_effect = terminate
+        started = time.monotonic()
+        main_loop(killer, 3600, commit=True, stop=stop)
+        self.assertLess(time.monotonic() - started, 60)
+        self.assertTrue(stop.is_set())
+        killer.vpn_reconnect.assert_called_once_with()
+        killer.disconnect_users.assert_called_once_with(mock.ANY, commit=True)
+        killer.vpn_disconnect.assert_called_once_with()
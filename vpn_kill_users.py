@@ -26,13 +26,215 @@
 # management /var/run/openvpn-udp-stage.socket unix
 # management-client-group vpnmgmt
 
+import logging
+import logging.handlers
+import os
+import signal
 import socket
 import sys
-from argparse import ArgumentParser
-import openvpn_management
-import iamvpnlibrary
+import threading
+import time
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
 sys.dont_write_bytecode = True
 
+# How many IAM lookups we're willing to have in flight at once, by default.
+# The IAM library object (and its LDAP connection) is shared by every
+# lookup, and it makes no promise of being safe to use from several
+# threads at once, so out of the box we ask one question at a time.
+# --iam-parallelism widens this, for an IAM library known to cope.
+IAM_WORKERS = 1
+# How many per-user IAM verdicts we'll remember, and for how many seconds.
+# "Yes" answers are only remembered if you ask for it (--iam-cache-ttl):
+# a remembered "yes" is how long a revoked user gets to stay on, and it
+# may be IAM's fail_open guess from an outage that has since ended.
+# "No" answers outlive one sweep interval (DAEMON_INTERVAL, or a
+# once-a-minute cron run) with room to spare, so the next sweep can use
+# them and the one after asks again.
+# These only pay off when verdicts outlive a sweep, i.e. in --daemon
+# mode or with --iam-cache-file.
+IAM_CACHE_SIZE = 4096
+IAM_CACHE_TTL = 0
+IAM_DENY_CACHE_TTL = 90
+# How long --daemon mode waits between sweeps, by default.
+DAEMON_INTERVAL = 60
+# How many seconds we wait on the management socket before giving up.
+CONNECT_TIMEOUT = 5
+
+
+LOGGER = logging.getLogger('vpn_kill_users')
+
+
+class BatchedStreamHandler(logging.handlers.BufferingHandler):
+    """
+        A log handler that holds on to records until it's flushed (or
+        full), and then writes them all out to the stream in one go,
+        rather than paying for a write (and a flush) per record.
+    """
+    def __init__(self, stream, capacity=1024):
+        super().__init__(capacity)
+        self.stream = stream
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.stream.write(''.join(self.format(record) + '\n'
+                                          for record in self.buffer))
+                self.stream.flush()
+                self.buffer = []
+        finally:
+            self.release()
+
+
+def _setup_logging():
+    """
+        Send our log messages to stdout, batched.  Only the first call
+        does anything, so main can be run over and over.
+    """
+    if not LOGGER.handlers:
+        LOGGER.addHandler(BatchedStreamHandler(sys.stdout))
+        LOGGER.setLevel(logging.INFO)
+        LOGGER.propagate = False
+
+
+class IAMUnavailableError(Exception):
+    """
+        We were unable to create the IAM library object, so we have no
+        way to check who may be on the VPN.
+    """
+
+
+class CacheFileError(Exception):
+    """
+        We were unable to open (or create) the on-disk IAM verdict cache.
+    """
+
+
+class VerdictCache:
+    """
+        The IAM verdicts we're holding on to: who IAM said may (or may
+        not) be on the VPN, and until when we'll believe it.
+    """
+    def __init__(self, *, ttl=IAM_CACHE_TTL, deny_ttl=IAM_DENY_CACHE_TTL,
+                 size=IAM_CACHE_SIZE, cache_file=None):
+        """
+            ttl is how long we trust an "allowed" verdict from IAM
+            before asking again; 0 means we always ask.  deny_ttl is
+            the same for a "not allowed" verdict.  size bounds how
+            many users' verdicts we hold on to.
+            cache_file, if given, is a sqlite file where verdicts are
+            kept between runs, so that cron-fired runs can share them.
+        """
+        self.ttl = ttl
+        self.deny_ttl = deny_ttl
+        self.size = size
+        # user -> (allowed, time.monotonic() at which we stop believing it)
+        # The cache file holds wall-clock times instead, since its
+        # verdicts outlive the process; see _open and save.
+        self._verdicts = {}
+        self._db = None
+        if cache_file is not None:
+            self._db = self._open(cache_file)
+
+    def get(self, user):
+        """
+            Returns (allowed, expires) for a user, or None if we don't
+            have a verdict for them.
+        """
+        return self._verdicts.get(user)
+
+    def remember(self, user, allowed, now):
+        """
+            Hold on to an IAM verdict for a while, so the next sweep
+            doesn't have to ask again.  If we're full up, the oldest
+            verdict makes way.
+            Returns (user, allowed, expires), or None if verdicts like
+            this one aren't to be remembered at all (a TTL of 0).
+        """
+        ttl = self.ttl if allowed else self.deny_ttl
+        if ttl <= 0:
+            return None
+        self._verdicts.pop(user, None)
+        if len(self._verdicts) >= self.size:
+            del self._verdicts[next(iter(self._verdicts))]
+        self._verdicts[user] = (allowed, now + ttl)
+        return user, allowed, now + ttl
+
+    def prune(self, now):
+        """
+            Drop every IAM verdict that has outlived its TTL.
+        """
+        self._verdicts = {user: verdict for user, verdict in self._verdicts.items()
+                          if verdict[1] > now}
+
+    def _open(self, cache_file):
+        """
+            Open (creating it if need be) the on-disk IAM verdict cache,
+            and load in every verdict from it that's still good.
+            The file is a list of VPN users and what IAM thinks of them,
+            so we create it readable by us alone.
+            Returns the sqlite connection.
+            Raises CacheFileError if the file can't be opened.
+        """
+        # sqlite3 is only needed by those who ask for a cache file.
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        try:
+            os.close(os.open(cache_file, os.O_RDWR | os.O_CREAT, 0o600))
+            cache_db = sqlite3.connect(cache_file)
+            cache_db.execute('PRAGMA journal_mode=WAL')
+            cache_db.execute('PRAGMA synchronous=NORMAL')
+            with cache_db:
+                cache_db.execute('CREATE TABLE IF NOT EXISTS iam_cache '
+                                 '(email TEXT PRIMARY KEY, allowed INT, expires REAL)')
+            wall_now = time.time()
+            rows = cache_db.execute('SELECT email, allowed, expires FROM iam_cache '
+                                    'WHERE expires > ?', (wall_now,)).fetchall()
+        except (OSError, sqlite3.Error) as dberr:
+            raise CacheFileError(f'{cache_file}: {str(dberr)}') from dberr
+        # The file may have been written by a run with longer TTLs than
+        # ours, and we believe no verdict for longer than we'd keep it.
+        verdicts = []
+        for email, allowed, expires in rows:
+            ttl = self.ttl if allowed else self.deny_ttl
+            if ttl > 0:
+                verdicts.append((min(expires, wall_now + ttl), email, bool(allowed)))
+        # Oldest first, to match the order remember keeps.
+        offset = time.monotonic() - wall_now
+        for expires, email, allowed in sorted(verdicts)[-self.size:]:
+            self._verdicts[email] = (allowed, expires + offset)
+        return cache_db
+
+    def save(self, verdicts, now):
+        """
+            Write freshly learned (user, allowed, expires) verdicts out to
+            the on-disk cache, if we have one, and clear out dead ones.
+            'now' is the time.monotonic() that the expiries count from.
+            Failing to do so is worth a warning, not a failed sweep.
+        """
+        if self._db is None:
+            return
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        offset = time.time() - now
+        try:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO iam_cache VALUES (?, ?, ?)',
+                                     [(user, allowed, expires + offset)
+                                      for user, allowed, expires in verdicts])
+                self._db.execute('DELETE FROM iam_cache WHERE expires <= ?',
+                                 (now + offset,))
+        except sqlite3.Error as dberr:
+            LOGGER.warning('Unable to save IAM verdicts to cache: %s', dberr)
+
+    def clear(self):
+        """
+            Forget every IAM verdict we're holding on to.
+        """
+        self._verdicts = {}
+        if self._db is not None:
+            with self._db:
+                self._db.execute('DELETE FROM iam_cache')
+
 
 class VPNkiller:
     """
@@ -40,15 +242,66 @@ class VPNkiller:
         It's really only a class in order to be testable.
         Much of this is trivial in nature.
     """
-    def __init__(self, vpn_socket):
+    def __init__(self, vpn_socket, *, iam_parallelism=IAM_WORKERS,
+                 connect_timeout=CONNECT_TIMEOUT, verdicts=None):
         """
             Creates a binding class that knows about the IAM object
             (for user validation) and the VPN object (for connection
             checking and killing).
+            iam_parallelism is how many per-user IAM checks we will have
+            in flight at once.
+            connect_timeout is how many seconds we wait on the management
+            socket before giving up on it.
+            verdicts is the VerdictCache of IAM answers we're allowed to
+            reuse; by default, one with the default TTLs and no file.
         """
         self.vpn_socket = vpn_socket
-        self.iam = iamvpnlibrary.IAMVPNLibrary()
-        self.vpn = openvpn_management.VPNmgmt(self.vpn_socket)
+        self.iam_parallelism = iam_parallelism
+        self.connect_timeout = connect_timeout
+        # The IAM object is built on first use; see the 'iam' property.
+        self._iam = None
+        self.vpn = self._new_vpn()
+        if verdicts is None:
+            verdicts = VerdictCache()
+        self.verdicts = verdicts
+
+    @property
+    def iam(self):
+        """
+            The IAM library object, which we only create the first time
+            someone needs it.  Most runs find nobody connected, and have
+            no reason to pay for importing the library, nor for its
+            connection setup.
+            Raises IAMUnavailableError if the object can't be made.
+        """
+        if self._iam is None:
+            try:
+                # iamvpnlibrary drags in a lot of network/TLS modules,
+                # so we only import it once we actually need IAM.
+                import iamvpnlibrary  # pylint: disable=import-outside-toplevel
+                self._iam = iamvpnlibrary.IAMVPNLibrary()
+            except Exception as iamerr:  # pylint: disable=broad-except
+                # We can throw any number of exceptions during the create
+                # process.  Notably, if the VPN goes isolated and can't
+                # talk to IAM.  So, we deliberately catch all error types,
+                # and hand back one that our callers can plan around.
+                raise IAMUnavailableError(str(iamerr)) from iamerr
+        return self._iam
+
+    def clear_iam_cache(self):
+        """
+            Forget every IAM verdict we're holding on to.
+        """
+        self.verdicts.clear()
+
+    def _new_vpn(self):
+        """
+            Make a VPNmgmt object for our socket.  Like iamvpnlibrary,
+            openvpn_management is imported on first use, so quick exits
+            (--help, bad arguments) don't pay for it.
+        """
+        import openvpn_management  # pylint: disable=import-outside-toplevel
+        return openvpn_management.VPNmgmt(self.vpn_socket)
 
     def vpn_connect(self):
         """
@@ -56,7 +309,12 @@ class VPNkiller:
             management socket.  The upstream can raise; we're not going
             to catch it initially, as an error shouldn't happen, and if
             it does we want the script to blow out this early.
+            A wedged OpenVPN can leave us waiting forever, so the socket
+            gets a timeout before we connect.  It stays in place for the
+            reads and writes that follow, and a socket.timeout is a
+            socket.error like any other.
         """
+        self.vpn.sock.settimeout(self.connect_timeout)
         try:
             self.vpn.connect()
             return True
@@ -69,72 +327,348 @@ class VPNkiller:
         """
         self.vpn.disconnect()
 
-    def get_users_to_disconnect(self):
+    def vpn_reconnect(self):
+        """
+            Drop the VPN management connection (if any) and make a fresh
+            one.  A closed socket can't be reconnected, so this builds a
+            new VPNmgmt object to do it.
+        """
+        try:
+            self.vpn.disconnect()
+        except socket.error:
+            pass
+        self.vpn = self._new_vpn()
+        return self.vpn_connect()
+
+    def _batch_allowed_users(self, users):
         """
-            Get a set of users who are to be disconnected from the VPN.
-            This is an intentionally simple marriage of "look at the
-            users on the VPN, and validate that they should still be
-            allowed to use the VPN."
+            Ask IAM about everyone at once, if it knows how.
+            Returns the set of allowed users, or None if the IAM library
+            has no batch way to tell us, and we must ask user-by-user.
+        """
+        batch_check = getattr(self.iam, 'users_allowed_to_vpn', None)
+        if batch_check is not None:
+            # If the IAM library can answer for everyone in one query,
+            # that beats any amount of fanning out on our side.  Like
+            # user_allowed_to_vpn, it answers for exactly the users we
+            # name, so the library's fail_open applies to each of them.
+            try:
+                return set(batch_check(users))
+            except NotImplementedError:
+                pass
+        return None
+
+    def _ask_iam(self, users):
+        """
+            Yield (user, allowed) for each of 'users', asking IAM in the
+            cheapest way it offers.
+        """
+        allowed_users = self._batch_allowed_users(users)
+        if allowed_users is not None:
+            for user in users:
+                yield user, user in allowed_users
+            return
+        # A word of note here, 'user_allowed_to_vpn' is a remote
+        # check, and thus, if we're disconnected from the server,
+        # will not know the truth from the IAM system.  There is
+        # a 'fail_open' check in the IAM library, and so we will
+        # abide by that decision in decidind to kill users.
+        # Each check is a network round trip, so if we're allowed to
+        # (see IAM_WORKERS), we run them side by side rather than one
+        # after another.
+        workers = min(self.iam_parallelism, len(users))
+        check = self.iam.user_allowed_to_vpn
+        if workers == 1:
+            yield from zip(users, map(check, users))
+            return
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from zip(users, executor.map(check, users))
+
+    def iter_users_to_disconnect(self):
+        """
+            Yield (user, user_ref) for each user who is to be disconnected
+            from the VPN.  This is an intentionally simple marriage of
+            "look at the users on the VPN, and validate that they should
+            still be allowed to use the VPN."
+            Users are yielded as soon as we know about them, so a caller
+            that kicks people off one at a time can begin doing so while
+            the remaining IAM checks are still in flight.
         """
         users_connected_to_vpn = self.vpn.getusers()
-        # users_connected_to_vpn is the list of emails on the VPN.
-        users_we_plan_to_disconnect = users_connected_to_vpn.copy()
-        for user in users_connected_to_vpn:
-            # We use 'user not in enabled users' rather than 'user in disabled
-            # users' because disabled users would be a higher level ACL,
-            # usually reserved for scripts running on the admin nodes.
-            # But we checked for minimum-good user sets above.
-            if self.iam.user_allowed_to_vpn(user):
-                # A word of note here, 'user_allowed_to_vpn' is a remote
-                # check, and thus, if we're disconnected from the server,
-                # will not know the truth from the IAM system.  There is
-                # a 'fail_open' check in the IAM library, and so we will
-                # abide by that decision in decidind to kill users.
-                del users_we_plan_to_disconnect[user]
-        return users_we_plan_to_disconnect
+        # users_connected_to_vpn is the dict of emails on the VPN.
+        if not users_connected_to_vpn:
+            # Nobody's here, so there's nothing to ask IAM about.
+            return
+        # Anyone we've asked about recently, we take the old answer for.
+        # In steady state that's nearly everyone, and IAM only hears
+        # about new arrivals and verdicts that have run out.
+        now = time.monotonic()
+        self.verdicts.prune(now)
+        users_to_ask = []
+        for user, user_ref in users_connected_to_vpn.items():
+            verdict = self.verdicts.get(user)
+            if verdict is None:
+                users_to_ask.append(user)
+            elif not verdict[0]:
+                yield user, user_ref
+        if not users_to_ask:
+            return
+        # We use 'user not in enabled users' rather than 'user in disabled
+        # users' because disabled users would be a higher level ACL,
+        # usually reserved for scripts running on the admin nodes.
+        fresh_verdicts = []
+        for user, allowed in self._ask_iam(users_to_ask):
+            verdict = self.verdicts.remember(user, allowed, now)
+            if verdict is not None:
+                fresh_verdicts.append(verdict)
+            if not allowed:
+                yield user, users_connected_to_vpn[user]
+        self.verdicts.save(fresh_verdicts, now)
+
+    def get_users_to_disconnect(self):
+        """
+            Get a dict of users who are to be disconnected from the VPN.
+            This is iter_users_to_disconnect, all gathered up.
+        """
+        return dict(self.iter_users_to_disconnect())
+
+    @staticmethod
+    def _announce_disconnect(user_ref):
+        """
+            log that we're going to disconnect someone
+        """
+        user = user_ref[0]
+        # Only strip the trailing port; IPv6 addresses have colons of their own.
+        src_ip = user_ref[1].rsplit(':', 1)[0]
+        LOGGER.info('disconnecting from VPN: %s / %s', user, src_ip,
+                    extra={'user': user, 'src_ip': src_ip})
+
+    @staticmethod
+    def flush_log():
+        """
+            Write out everything we've logged so far.  See BatchedStreamHandler.
+        """
+        for handler in LOGGER.handlers:
+            handler.flush()
 
     def disconnect_user(self, user_ref, commit=False):
         """
             log that we're going to disconnect someone, and then do so
         """
-        user = user_ref[0]
-        src_ip = user_ref[1].split(':')[0]
-        msg = "disconnecting from VPN: {user} / {ip}"
-        print(msg.format(user=user, ip=src_ip))
-        kill_tuple = self.vpn.kill(user, commit=commit)
+        self._announce_disconnect(user_ref)
+        kill_tuple = self.vpn.kill(user_ref[0], commit=commit)
         return kill_tuple[0]
 
+    def disconnect_users(self, user_refs, commit=False):
+        """
+            log that we're going to disconnect a group of people, and
+            then do so.  If the VPN library can pipeline several kills
+            down the management socket in one go, we use that; otherwise
+            it's one kill (and one round trip) at a time.
+            A pipelined batch needs everyone up front, so that path reads
+            all of user_refs before it sends anything; only the per-user
+            path kicks people off as user_refs hands them over.
+            Returns a list of the per-user kill results.
+        """
+        if hasattr(self.vpn, 'kill_many'):
+            user_refs = list(user_refs)
+            for user_ref in user_refs:
+                self._announce_disconnect(user_ref)
+            kill_tuples = self.vpn.kill_many([user_ref[0] for user_ref in user_refs],
+                                             commit=commit)
+            return [kill_tuple[0] for kill_tuple in kill_tuples]
+        return [self.disconnect_user(user_ref, commit=commit)
+                for user_ref in user_refs]
 
-def main(argv):
+
+def _positive_int(value):
     """
-        The primary function, which does obviously trivial work.
+        argparse type for 'a count of things, at least one'
+    """
+    try:
+        ivalue = int(value)
+    except ValueError:
+        ivalue = 0
+    if ivalue < 1:
+        raise ArgumentTypeError(f'{value} is not a positive integer')
+    return ivalue
+
+
+def _non_negative_int(value):
+    """
+        argparse type for 'a count of things, where none is fine'
+    """
+    try:
+        ivalue = int(value)
+    except ValueError:
+        ivalue = -1
+    if ivalue < 0:
+        raise ArgumentTypeError(f'{value} is not a non-negative integer')
+    return ivalue
+
+
+class SignalStop:
+    """
+        A stand-in for threading.Event, for main_loop, that is set by a
+        signal.  A signal handler would have to take the Event's lock,
+        which our own thread may be holding in wait() at the time, so
+        instead we block the signal and pick it up while we wait.
+        A signal that comes in mid-sweep waits until the sweep is done.
+    """
+    def __init__(self, signum):
+        self.signum = signum
+        self._set = False
+        # Threads started from here on (the IAM fan-out's, say) inherit
+        # the blocked signal, so it can only be picked up in wait().
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signum})
+
+    def is_set(self):
+        """
+            Whether the signal has turned up yet.
+        """
+        return self._set
+
+    def wait(self, timeout):
+        """
+            Sleep for up to 'timeout' seconds, or until the signal turns
+            up, whichever is sooner.  Returns whether it has turned up.
+        """
+        if not self._set and signal.sigtimedwait({self.signum}, timeout) is not None:
+            self._set = True
+        return self._set
+
+
+def sweep(killer_object, commit=False):
+    """
+        One pass of "find who shouldn't be here, and kick them off."
+    """
+    try:
+        user_refs = (user_ref for _user, user_ref
+                     in killer_object.iter_users_to_disconnect())
+        killer_object.disconnect_users(user_refs, commit=commit)
+    finally:
+        # Whoever we announced, we write out now, even if the sweep
+        # fell over partway: that's the record of who got kicked.
+        killer_object.flush_log()
+
+
+def main_loop(killer_object, interval, commit=True, stop=None):
+    """
+        The long-running flavor of main: rather than being fired from
+        cron and paying for setup every time, keep one VPNkiller (and so
+        one IAM object, and its cached verdicts) alive across sweeps.
+        The management socket we reopen for each sweep and let go of
+        afterwards, since OpenVPN only allows one management client at
+        a time, and we shouldn't hog it while we sleep.
+        Sweeps every 'interval' seconds until 'stop' (an Event, or a
+        SignalStop) is set.
+    """
+    if stop is None:
+        stop = threading.Event()
+    while not stop.is_set():
+        if killer_object.vpn_reconnect():
+            try:
+                sweep(killer_object, commit=commit)
+            except socket.error as sockerr:
+                # The socket went away under us.  Try again next time.
+                print(f'Lost connection to {killer_object.vpn_socket}: {str(sockerr)}')
+            except IAMUnavailableError as iamerr:
+                # IAM may well be back by next time.
+                print(f'Unable to create IAM object: {str(iamerr)}')
+            try:
+                killer_object.vpn_disconnect()
+            except socket.error:
+                pass
+        else:
+            print(f'Unable to connect to {killer_object.vpn_socket}')
+        stop.wait(interval)
+
+
+def _build_parser():
+    """
+        Put together the argument parser.  This happens once, at import,
+        rather than on every call to main.
     """
     parser = ArgumentParser(description='Args to the kill script')
     parser.add_argument('--noop', action='store_true', required=False,
                         help='Do not disconnect anyone',
                         dest='noop', default=False)
+    parser.add_argument('--daemon', action='store_true', required=False,
+                        help='Keep running, sweeping every --interval seconds',
+                        dest='daemon', default=False)
+    parser.add_argument('--interval', type=_positive_int, required=False,
+                        help='Seconds between sweeps in --daemon mode',
+                        dest='interval', default=DAEMON_INTERVAL)
+    parser.add_argument('--connect-timeout', type=_positive_int, required=False,
+                        help='Seconds to wait on the VPN management socket',
+                        dest='connect_timeout', default=CONNECT_TIMEOUT)
+    parser.add_argument('--iam-parallelism', type=_positive_int, required=False,
+                        help='How many IAM checks to run at once',
+                        dest='iam_parallelism', default=IAM_WORKERS)
+    parser.add_argument('--iam-cache-ttl', type=_non_negative_int, required=False,
+                        help=('Seconds to trust an IAM "allowed" answer before '
+                              'asking again (default 0: always ask)'),
+                        dest='cache_ttl', default=IAM_CACHE_TTL)
+    parser.add_argument('--iam-deny-cache-ttl', type=_non_negative_int, required=False,
+                        help=('Seconds to trust an IAM "not allowed" answer '
+                              '(0: always ask)'),
+                        dest='deny_cache_ttl', default=IAM_DENY_CACHE_TTL)
+    parser.add_argument('--iam-cache-file', type=str, required=False,
+                        help=('sqlite file to keep IAM answers in between runs, '
+                              'e.g. /var/cache/vpn_kill_users.sqlite'),
+                        dest='cache_file', default=None)
+    parser.add_argument('--iam-cache-size', type=_positive_int, required=False,
+                        help='How many users to remember IAM answers for',
+                        dest='cache_size', default=IAM_CACHE_SIZE)
     parser.add_argument('vpn_socket', type=str,
                         help='VPN management socket to connect to.')
-    args = parser.parse_args(argv)
+    return parser
+
+
+_PARSER = _build_parser()
+
+
+def main(argv):
+    """
+        The primary function, which does obviously trivial work.
+    """
+    args = _PARSER.parse_args(argv)
+    _setup_logging()
 
     try:
-        killer_object = VPNkiller(args.vpn_socket)
-    except Exception as objerr:  # pylint: disable=broad-except
-        # We can throw any number of exceptions during the create process.
-        # Notably, if the VPN goes isolated and can't talk to IAM.
-        # So, we deliberately catch all error types, because creating
-        # the list would make this complex, for no benefit.
+        verdicts = VerdictCache(ttl=args.cache_ttl, deny_ttl=args.deny_cache_ttl,
+                                size=args.cache_size, cache_file=args.cache_file)
+        killer_object = VPNkiller(args.vpn_socket,
+                                  iam_parallelism=args.iam_parallelism,
+                                  connect_timeout=args.connect_timeout,
+                                  verdicts=verdicts)
+    except (ImportError, socket.error, CacheFileError) as objerr:
+        # IAM is only set up on first use (and has its own error for
+        # that), so all that can go wrong here is a missing VPN library,
+        # no socket for it, or an unusable cache file.
         print(f'Unable to create VPNkiller object: {str(objerr)}')
         sys.exit(1)
 
+    if args.daemon:
+        # SIGTERM (from systemd, say) ends the loop after the current sweep.
+        stop = SignalStop(signal.SIGTERM)
+        main_loop(killer_object, args.interval, commit=not args.noop, stop=stop)
+        return
+
     if not killer_object.vpn_connect():
         print(f'Unable to connect to {args.vpn_socket}')
         sys.exit(1)
 
-    users_to_disconnect = killer_object.get_users_to_disconnect()
-
-    for _user, user_ref in users_to_disconnect.items():
-        killer_object.disconnect_user(user_ref, commit=not args.noop)
+    try:
+        sweep(killer_object, commit=not args.noop)
+    except IAMUnavailableError as iamerr:
+        print(f'Unable to create IAM object: {str(iamerr)}')
+        killer_object.vpn_disconnect()
+        sys.exit(1)
+    except socket.error as sockerr:
+        # Including a socket.timeout, if it stops answering.
+        print(f'Lost connection to {args.vpn_socket}: {str(sockerr)}')
+        sys.exit(1)
 
     killer_object.vpn_disconnect()
 